@@ -1,15 +1,16 @@
 import os
 import logging
 import json
+import sqlite3
 import re
 import asyncio
+import concurrent.futures
 from datetime import datetime
 import easyocr
 import cv2
 import numpy as np
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-import tempfile
 
 # Configurar logging
 logging.basicConfig(
@@ -20,6 +21,21 @@ logging.basicConfig(
 # Variables de entorno
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 ALLOWED_USERS = [int(id) for id in os.getenv('ALLOWED_USERS', '').split(',') if id]
+# Caché de modelos en ruta persistente (montar como volumen en el deploy)
+EASYOCR_MODEL_DIR = os.getenv('EASYOCR_MODEL_DIR', os.path.expanduser('~/.easyocr'))
+# EasyOCR normaliza internamente y prefiere color: binarizar de más puede
+# empeorar la lectura. Activar solo para comparar con el preprocesado propio.
+PREPROCESS_TICKETS = os.getenv('PREPROCESS_TICKETS', '0') == '1'
+
+# Patrones precompilados para parsear tickets (evita recompilar en cada foto)
+FECHA_RE = re.compile(r'(\d{1,2}[/-]\d{1,2}[/-]\d{2,4})')
+HORA_RE = re.compile(r'(\d{1,2}:\d{2})')
+# El total con palabra clave tiene prioridad: los tickets imprimen precios
+# con símbolo de moneda antes de la línea TOTAL
+TOTAL_RE = re.compile(r'(?:total|importe|final)[\s:]*\$?\s*(\d+(?:[.,]\d+)?)', re.IGNORECASE)
+TOTAL_MONEDA_RE = re.compile(r'[$€]\s*(\d+[.,]\d+)')
+PRODUCT_RE = re.compile(r'([A-Za-z\s]+)\s+(\d+[.,]\d+)')
+BLOCK_RE = re.compile(r'total|fecha|hora|ticket', re.IGNORECASE)
 
 # SOLUCIÓN: Forzar la descarga de modelos al inicio
 def initialize_easyocr():
@@ -28,10 +44,12 @@ def initialize_easyocr():
         # Descargar modelos explícitamente
         logging.info("Descargando modelos de EasyOCR...")
         reader = easyocr.Reader(
-            ['es', 'en'], 
+            ['es', 'en'],
             gpu=False,
+            quantize=True,  # Reconocedor en int8: 2-4x más rápido en CPU
+            detect_network='dbnet18',  # Detector ligero, suficiente para tickets impresos
             download_enabled=True,
-            model_storage_directory='/tmp/.easyocr'  # Usar directorio temporal persistente
+            model_storage_directory=EASYOCR_MODEL_DIR
         )
         logging.info("Modelos de EasyOCR cargados correctamente")
         return reader
@@ -43,67 +61,143 @@ class GestorCompras:
     def __init__(self):
         try:
             self.reader = initialize_easyocr()
-            self.data_file = 'compras.json'
-            self.load_data()
+            self.db_file = 'compras.db'
+            self.init_db()
+            self.warmup()
             logging.info("Gestor de Compras inicializado correctamente")
         except Exception as e:
             logging.error(f"Error en inicialización: {e}")
             self.reader = None
-    
-    def load_data(self):
-        """Carga los datos existentes"""
+
+    def warmup(self):
+        """Calienta el OCR y los regex antes de aceptar peticiones"""
         try:
-            if os.path.exists(self.data_file):
-                with open(self.data_file, 'r', encoding='utf-8') as f:
-                    self.data = json.load(f)
-            else:
-                self.data = {'compras': []}
+            inicio = datetime.now()
+            # Inferencia de prueba: dispara la init perezosa de torch antes
+            # de la primera foto real
+            self.reader.readtext(np.full((100, 100, 3), 255, np.uint8))
+            probe = 'Super Prueba 01/01/2024 12:30 total: $9.99'
+            for pattern in (FECHA_RE, HORA_RE, TOTAL_RE, PRODUCT_RE, BLOCK_RE):
+                pattern.search(probe)
+            duracion = (datetime.now() - inicio).total_seconds()
+            logging.info(f"Warm-up completado en {duracion:.1f}s")
         except Exception as e:
-            logging.error(f"Error cargando datos: {e}")
-            self.data = {'compras': []}
-    
-    def save_data(self):
-        """Guarda los datos"""
+            logging.error(f"Error en warm-up: {e}")
+
+    def init_db(self):
+        """Abre la base SQLite y crea la tabla si no existe"""
+        self.conn = sqlite3.connect(self.db_file, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS purchases (
+                id INTEGER PRIMARY KEY,
+                fecha TEXT,
+                hora TEXT,
+                establecimiento TEXT,
+                total REAL,
+                productos TEXT,
+                imagen TEXT,
+                registro TEXT
+            )
+        ''')
+        self.migrate_json()
+
+    def migrate_json(self):
+        """Importa el antiguo compras.json si la tabla está vacía"""
         try:
-            with open(self.data_file, 'w', encoding='utf-8') as f:
-                json.dump(self.data, f, ensure_ascii=False, indent=2)
+            if not os.path.exists('compras.json'):
+                return
+            if self.conn.execute('SELECT COUNT(*) FROM purchases').fetchone()[0]:
+                return
+            with open('compras.json', 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            for compra in data.get('compras', []):
+                self.conn.execute(
+                    'INSERT INTO purchases (fecha, hora, establecimiento, total, productos, imagen, registro) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (compra.get('fecha_compra'), compra.get('hora_compra'),
+                     compra.get('establecimiento'), compra.get('total', 0),
+                     json.dumps(compra.get('productos', []), ensure_ascii=False),
+                     compra.get('imagen_ticket'), compra.get('fecha_registro'))
+                )
+            logging.info("Compras migradas de compras.json a SQLite")
         except Exception as e:
-            logging.error(f"Error guardando datos: {e}")
-    
-    def preprocess_image(self, image_path):
+            logging.error(f"Error migrando compras.json: {e}")
+
+    def downscale_image(self, image):
+        """Reduce fotos grandes: el detector de OCR escala con los píxeles"""
+        h, w = image.shape[:2]
+        scale = 1024 / max(h, w)
+        if scale < 1:
+            image = cv2.resize(image, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+        return image
+
+    def prepare_image(self, image):
+        """Prepara la imagen para el OCR según la configuración"""
+        if image is None:
+            return None
+        image = self.downscale_image(image)
+        if PREPROCESS_TICKETS:
+            return self.preprocess_image(image)
+        return image
+
+    def preprocess_image(self, image):
         """Mejora la imagen para mejor OCR"""
         try:
-            image = cv2.imread(image_path)
             if image is None:
                 raise ValueError("No se pudo cargar la imagen")
-            
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            denoised = cv2.medianBlur(gray, 5)
-            thresh = cv2.threshold(denoised, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
-            return thresh
+
+            # UMat: OpenCV usa OpenCL (iGPU) si hay dispositivo; si no, cae a CPU
+            umat = cv2.UMat(image)
+            gray = cv2.cvtColor(umat, cv2.COLOR_BGR2GRAY)
+            # Gaussiano separable: mucho más barato que la mediana 5x5.
+            # Si la imagen ya es nítida, el desenfoque no aporta nada.
+            _, stddev = cv2.meanStdDev(cv2.Laplacian(gray, cv2.CV_64F))
+            if stddev[0][0] ** 2 > 200:
+                denoised = gray
+            else:
+                denoised = cv2.GaussianBlur(gray, (3, 3), 0)
+
+            # Compensar iluminación desigual (sombras, flash) dividiendo por
+            # el fondo estimado, para que Otsu no se coma texto en zonas oscuras
+            fondo = cv2.GaussianBlur(denoised, (51, 51), 0)
+            compensada = cv2.divide(denoised, fondo, scale=255)
+
+            thresh = cv2.threshold(compensada, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+            return thresh.get()
         except Exception as e:
             logging.error(f"Error procesando imagen: {e}")
             return None
     
-    def extract_text_from_ticket(self, image_path):
-        """Extrae texto de la imagen del ticket"""
+    def extract_text_from_tickets_batch(self, images):
+        """Extrae texto de varios tickets en una sola pasada del OCR"""
         try:
             if self.reader is None:
-                return "Error: OCR no inicializado", []
-                
-            processed_image = self.preprocess_image(image_path)
-            if processed_image is None:
-                return "Error procesando imagen", []
-                
-            results = self.reader.readtext(processed_image, detail=1)
-            full_text = ' '.join([result[1] for result in results])
-            return full_text, results
+                return [("Error: OCR no inicializado", []) for _ in images]
+
+            procesadas = [self.prepare_image(image) for image in images]
+            validas = [img for img in procesadas if img is not None]
+            if not validas:
+                return [("Error procesando imagen", []) for _ in images]
+
+            # Un solo lote por el detector/reconocedor en vez de N llamadas
+            lotes = self.reader.readtext_batched(validas, n_width=1024, n_height=1024)
+
+            salida = []
+            it = iter(lotes)
+            for img in procesadas:
+                if img is None:
+                    salida.append(("Error procesando imagen", []))
+                else:
+                    results = next(it)
+                    salida.append((' '.join([result[1] for result in results]), results))
+            return salida
         except Exception as e:
-            logging.error(f"Error en OCR: {e}")
-            return f"Error en OCR: {str(e)}", []
-    
-    def parse_ticket_info(self, text):
-        """Extrae información específica del ticket"""
+            logging.error(f"Error en OCR por lotes: {e}")
+            return [(f"Error en OCR: {str(e)}", []) for _ in images]
+
+    def parse_ticket_info(self, results):
+        """Extrae información específica del ticket desde los bloques del OCR"""
         info = {
             'fecha': None,
             'hora': None,
@@ -111,42 +205,42 @@ class GestorCompras:
             'establecimiento': None,
             'productos': []
         }
-        
+
         try:
+            # Cada bloque del OCR es una línea del ticket; el join con espacios
+            # borraba los saltos de línea de los que dependía el parseo
+            lines = [result[1] for result in results]
+            text = ' '.join(lines)
             # Buscar fecha (formato dd/mm/aaaa o dd-mm-aaaa)
-            fecha_pattern = r'(\d{1,2}[/-]\d{1,2}[/-]\d{2,4})'
-            fecha_match = re.search(fecha_pattern, text)
+            fecha_match = FECHA_RE.search(text)
             if fecha_match:
                 info['fecha'] = fecha_match.group(1)
-            
+
             # Buscar hora (formato hh:mm)
-            hora_pattern = r'(\d{1,2}:\d{2})'
-            hora_match = re.search(hora_pattern, text)
+            hora_match = HORA_RE.search(text)
             if hora_match:
                 info['hora'] = hora_match.group(1)
-            
+
             # Buscar total (patrones comunes)
-            total_patterns = [
-                r'total[\s:]*\$?\s*(\d+[.,]\d+)',
-                r'total[\s:]*\$?\s*(\d+)',
-                r'importe[\s:]*\$?\s*(\d+[.,]\d+)',
-                r'[\$€]\s*(\d+[.,]\d+)',
-                r'final[\s:]*\$?\s*(\d+[.,]\d+)'
-            ]
-            
-            for pattern in total_patterns:
-                total_match = re.search(pattern, text.lower())
-                if total_match:
-                    info['total'] = total_match.group(1).replace(',', '.')
-                    break
+            total_match = TOTAL_RE.search(text) or TOTAL_MONEDA_RE.search(text)
+            if total_match:
+                info['total'] = total_match.group(1).replace(',', '.')
             
-            # Buscar establecimiento
-            lines = text.split('\n')
+            # Buscar establecimiento en los primeros bloques detectados
             for line in lines[:3]:
-                if len(line.strip()) > 5 and not any(word in line.lower() for word in ['total', 'fecha', 'hora', 'ticket']):
+                if len(line.strip()) > 5 and not BLOCK_RE.search(line):
                     info['establecimiento'] = line.strip()[:50]
                     break
-            
+
+            # Buscar productos línea a línea (nombre seguido de precio)
+            for line in lines:
+                producto_match = PRODUCT_RE.search(line)
+                if producto_match:
+                    info['productos'].append({
+                        'nombre': producto_match.group(1).strip(),
+                        'precio': producto_match.group(2).replace(',', '.')
+                    })
+
             return info
             
         except Exception as e:
@@ -157,7 +251,6 @@ class GestorCompras:
         """Añade una nueva compra"""
         try:
             compra = {
-                'id': len(self.data['compras']) + 1,
                 'fecha_compra': ticket_info.get('fecha'),
                 'hora_compra': ticket_info.get('hora'),
                 'establecimiento': ticket_info.get('establecimiento'),
@@ -166,27 +259,50 @@ class GestorCompras:
                 'imagen_ticket': image_path,
                 'fecha_registro': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             }
-            
-            self.data['compras'].append(compra)
-            self.save_data()
+
+            cursor = self.conn.execute(
+                'INSERT INTO purchases (fecha, hora, establecimiento, total, productos, imagen, registro) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (compra['fecha_compra'], compra['hora_compra'], compra['establecimiento'],
+                 compra['total'], json.dumps(compra['productos'], ensure_ascii=False),
+                 compra['imagen_ticket'], compra['fecha_registro'])
+            )
+            compra['id'] = cursor.lastrowid
             return compra
         except Exception as e:
             logging.error(f"Error añadiendo compra: {e}")
             return None
+
+    def get_recent(self, limit=5):
+        """Devuelve las últimas compras registradas"""
+        try:
+            filas = self.conn.execute(
+                'SELECT fecha, establecimiento, total FROM purchases ORDER BY id DESC LIMIT ?',
+                (limit,)
+            ).fetchall()
+            return [
+                {'fecha_compra': fecha, 'establecimiento': establecimiento, 'total': total}
+                for fecha, establecimiento, total in reversed(filas)
+            ]
+        except Exception as e:
+            logging.error(f"Error listando compras: {e}")
+            return []
     
     def get_stats(self):
         """Obtiene estadísticas de compras"""
         try:
-            if not self.data['compras']:
+            total_compras, gasto_total, compra_promedio = self.conn.execute(
+                'SELECT COUNT(*), SUM(total), AVG(total) FROM purchases'
+            ).fetchone()
+            if not total_compras:
                 return None
-            
-            total_compras = len(self.data['compras'])
-            gasto_total = sum(compra['total'] for compra in self.data['compras'])
-            compra_promedio = gasto_total / total_compras if total_compras > 0 else 0
-            
-            establecimientos = [compra['establecimiento'] for compra in self.data['compras'] if compra['establecimiento']]
-            establecimiento_frecuente = max(set(establecimientos), key=establecimientos.count) if establecimientos else 'N/A'
-            
+
+            fila = self.conn.execute(
+                'SELECT establecimiento FROM purchases WHERE establecimiento IS NOT NULL '
+                'GROUP BY establecimiento ORDER BY COUNT(*) DESC LIMIT 1'
+            ).fetchone()
+            establecimiento_frecuente = fila[0] if fila else 'N/A'
+
             return {
                 'total_compras': total_compras,
                 'gasto_total': gasto_total,
@@ -200,7 +316,11 @@ class GestorCompras:
 class TelegramBot:
     def __init__(self, gestor_compras):
         self.gestor = gestor_compras
-        self.application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+        # El OCR es CPU-bound: se ejecuta en hilos para no bloquear el event loop
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count())
+        # Cola que agrupa fotos concurrentes para pasarlas al OCR en lote
+        self._ocr_queue = asyncio.Queue()
+        self.application = Application.builder().token(TELEGRAM_BOT_TOKEN).post_init(self._start_ocr_worker).build()
         
         # Handlers
         self.application.add_handler(CommandHandler("start", self.start))
@@ -209,6 +329,39 @@ class TelegramBot:
         self.application.add_handler(MessageHandler(filters.PHOTO, self.handle_photo))
         self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_text))
     
+    async def _start_ocr_worker(self, application):
+        # Guardar la referencia: una tarea sin referencia puede ser recolectada,
+        # y sin este worker ningún future de foto se completa
+        self._ocr_task = asyncio.create_task(self._ocr_batch_worker())
+        self._ocr_task.add_done_callback(self._ocr_worker_done)
+
+    def _ocr_worker_done(self, task):
+        if task.cancelled():
+            return
+        logging.error(f"El worker de OCR terminó inesperadamente: {task.exception()}")
+
+    async def _ocr_batch_worker(self):
+        """Agrupa fotos pendientes ~100ms y las procesa en un solo lote"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._ocr_queue.get()]
+            await asyncio.sleep(0.1)
+            while not self._ocr_queue.empty():
+                batch.append(self._ocr_queue.get_nowait())
+
+            imagenes = [imagen for imagen, _ in batch]
+            try:
+                resultados = await loop.run_in_executor(
+                    self.executor, self.gestor.extract_text_from_tickets_batch, imagenes
+                )
+                for (_, future), resultado in zip(batch, resultados):
+                    if not future.done():
+                        future.set_result(resultado)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
         
@@ -241,23 +394,28 @@ Envía una foto de tu ticket y extraeré automáticamente:
         await update.message.reply_text("📷 Procesando ticket...")
         
         try:
-            # Descargar foto
+            # Descargar foto y decodificarla una sola vez, en memoria
             photo_file = await update.message.photo[-1].get_file()
-            
-            # Usar archivo temporal
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as tmp_file:
-                image_path = tmp_file.name
-            
-            await photo_file.download_to_drive(image_path)
-            
-            # Procesar con OCR
-            text, _ = self.gestor.extract_text_from_ticket(image_path)
-            
+            buf = await photo_file.download_as_bytearray()
+            image = cv2.imdecode(np.frombuffer(buf, np.uint8), cv2.IMREAD_COLOR)
+
+            if image is None:
+                await update.message.reply_text("❌ Error procesando imagen. Intenta con otra foto.")
+                return
+
+            # Encolar para el OCR por lotes (no bloquea a otros usuarios)
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            await self._ocr_queue.put((image, future))
+            text, results = await future
+
             if "Error" in text:
                 await update.message.reply_text("❌ Error procesando imagen. Intenta con otra foto.")
                 return
-                
-            ticket_info = self.gestor.parse_ticket_info(text)
+
+            ticket_info = await loop.run_in_executor(
+                self.executor, self.gestor.parse_ticket_info, results
+            )
             
             # Guardar compra
             compra = self.gestor.add_purchase(ticket_info, "ticket_temp.jpg")
@@ -272,10 +430,7 @@ Envía una foto de tu ticket y extraeré automáticamente:
 💰 *Total:* ${ticket_info.get('total', '0')}
 """
             await update.message.reply_text(response, parse_mode='Markdown')
-            
-            # Limpiar archivo temporal
-            os.unlink(image_path)
-            
+
         except Exception as e:
             logging.error(f"Error procesando foto: {e}")
             await update.message.reply_text("❌ Error procesando ticket. Intenta con otra foto.")
@@ -310,7 +465,7 @@ Envía una foto de tu ticket y extraeré automáticamente:
             await update.message.reply_text("❌ No tienes acceso.")
             return
         
-        compras = self.gestor.data['compras'][-5:]
+        compras = self.gestor.get_recent(5)
         
         if not compras:
             await update.message.reply_text("📝 No hay compras.")